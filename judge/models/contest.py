@@ -1,3 +1,6 @@
+import uuid
+
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
 from django.db import models, transaction
@@ -192,6 +195,13 @@ class Contest(models.Model):
             return True
         return False
 
+    @cached_property
+    def organizer_ids(self):
+        # Reuse prefetched organizers, e.g. from the contest list, rather than querying for each contest.
+        if 'organizers' in getattr(self, '_prefetched_objects_cache', ()):
+            return frozenset(organizer.id for organizer in self.organizers.all())
+        return frozenset(self.organizers.values_list('id', flat=True))
+
     @cached_property
     def show_scoreboard(self):
         if not self.can_join:
@@ -239,7 +249,7 @@ class Contest(models.Model):
 
     def update_user_count(self):
         self.user_count = self.users.filter(virtual=0).count()
-        self.save()
+        self.save(update_fields=['user_count'])
 
     update_user_count.alters_data = True
 
@@ -270,7 +280,7 @@ class Contest(models.Model):
             if self.view_contest_scoreboard.filter(id=user.profile.id).exists():
                 return
 
-            in_org = self.organizations.filter(id__in=user.profile.organizations.all()).exists()
+            in_org = self.organizations.filter(member=user.profile).exists()
             in_users = self.private_contestants.filter(id=user.profile.id).exists()
         else:
             in_org = False
@@ -305,8 +315,7 @@ class Contest(models.Model):
             return True
 
         # If the user is a contest organizer
-        if user.has_perm('judge.edit_own_contest') and \
-                self.organizers.filter(id=user.profile.id).exists():
+        if user.has_perm('judge.edit_own_contest') and user.profile.id in self.organizer_ids:
             return True
 
         return False
@@ -333,6 +342,14 @@ class Contest(models.Model):
             queryset = queryset.filter(q)
         return queryset.distinct()
 
+    @property
+    def ranking_version(self):
+        # Changes whenever a participation in this contest is rescored, see ContestParticipation.recompute_results.
+        return cache.get_or_set('contest_ranking_version:%d' % self.id, lambda: uuid.uuid4().hex, None)
+
+    def invalidate_ranking(self):
+        cache.delete('contest_ranking_version:%d' % self.id)
+
     def rate(self):
         Rating.objects.filter(contest__end_time__gte=self.end_time).delete()
         for contest in Contest.objects.filter(is_rated=True, end_time__gte=self.end_time).order_by('end_time'):
@@ -352,6 +369,9 @@ class Contest(models.Model):
             ('contest_problem_label', _('Edit contest problem label script')),
             ('lock_contest', _('Change lock status of contest')),
         )
+        indexes = [
+            models.Index(fields=['start_time', 'end_time'], name='judge_contest_time_range'),
+        ]
         verbose_name = _('contest')
         verbose_name_plural = _('contests')
 
@@ -378,6 +398,7 @@ class ContestParticipation(models.Model):
             if self.is_disqualified:
                 self.score = -9999
                 self.save(update_fields=['score'])
+        transaction.on_commit(self.contest.invalidate_ranking)
     recompute_results.alters_data = True
 
     def set_disqualified(self, disqualified):
@@ -99,6 +99,11 @@ class ContestTestCase(CommonDataMixin, TestCase):
         self.assertFalse(self.basic_contest.ended)
         self.assertEqual(str(self.basic_contest), self.basic_contest.name)
         self.assertEqual(self.basic_contest.get_label_for_problem(0), '1')
+        organizer_ids = {self.users['superuser'].profile.id, self.users['staff_contest_edit_own'].profile.id}
+        self.assertEqual(self.basic_contest.organizer_ids, organizer_ids)
+        prefetched = Contest.objects.prefetch_related('organizers').get(id=self.basic_contest.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(prefetched.organizer_ids, organizer_ids)
 
     def test_hidden_scoreboard_contest(self):
         self.assertFalse(self.hidden_scoreboard_contest.show_scoreboard)
@@ -61,11 +61,16 @@ def contest_update(sender, instance, **kwargs):
     if hasattr(instance, '_updating_stats_only'):
         return
 
-    cache.delete_many(['generated-meta-contest:%d' % instance.id] +
+    cache.delete_many(['generated-meta-contest:%d' % instance.id, 'contest_bounds'] +
                       [make_template_fragment_key('contest_html', (instance.id, engine))
                        for engine in EFFECTIVE_MATH_ENGINES])
 
 
+@receiver(post_delete, sender=Contest)
+def contest_delete(sender, instance, **kwargs):
+    cache.delete('contest_bounds')
+
+
 @receiver(post_save, sender=License)
 def license_update(sender, instance, **kwargs):
     cache.delete(make_template_fragment_key('license_html', (instance.id,)))
@@ -3,7 +3,6 @@ from calendar import Calendar, SUNDAY
 from collections import defaultdict, namedtuple
 from datetime import date, datetime, time, timedelta
 from functools import partial
-from itertools import chain
 from operator import attrgetter, itemgetter
 
 from django import forms
@@ -11,12 +10,14 @@ from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from django.db import IntegrityError
-from django.db.models import Case, Count, F, FloatField, IntegerField, Max, Min, Q, Sum, Value, When
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, F, FloatField, IntegerField, Max, Min, Sum, Value, When, Window
 from django.db.models.expressions import CombinedExpression
+from django.db.models.functions import Rank
 from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.template.defaultfilters import date as date_filter
+from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -59,8 +60,15 @@ def _find_contest(request, key, private_check=True):
 
 
 class ContestListMixin(object):
+    @cached_property
+    def _visible_contests(self):
+        # Contest listings never render these, and format_config would otherwise be JSON-decoded for every row.
+        return Contest.get_visible_contests(self.request.user).defer('summary', 'problem_label_script',
+                                                                     'format_config')
+
     def get_queryset(self):
-        return Contest.get_visible_contests(self.request.user)
+        # Clone so that the memoized queryset itself is never evaluated and cached.
+        return self._visible_contests.all()
 
 
 class ContestList(QueryStringSortMixin, DiggPaginatorMixin, TitleMixin, ContestListMixin, ListView):
@@ -86,24 +94,25 @@ class ContestList(QueryStringSortMixin, DiggPaginatorMixin, TitleMixin, ContestL
     def get_context_data(self, **kwargs):
         context = super(ContestList, self).get_context_data(**kwargs)
         present, active, future = [], [], []
-        for contest in self._get_queryset().exclude(end_time__lt=self._now):
+        for contest in self._get_queryset().filter(end_time__gte=self._now).order_by('start_time'):
             if contest.start_time > self._now:
                 future.append(contest)
             else:
                 present.append(contest)
 
         if self.request.user.is_authenticated:
+            # Reuse the contests we already loaded (with their prefetches) instead of fetching them again.
+            present_by_id = {contest.id: contest for contest in present}
             for participation in ContestParticipation.objects.filter(virtual=0, user=self.request.profile,
-                                                                     contest_id__in=present) \
-                    .select_related('contest').prefetch_related('contest__organizers') \
+                                                                     contest_id__in=list(present_by_id)) \
                     .annotate(key=F('contest__key')):
+                participation.contest = present_by_id[participation.contest_id]
                 if not participation.ended:
                     active.append(participation)
                     present.remove(participation.contest)
 
         active.sort(key=attrgetter('end_time', 'key'))
         present.sort(key=attrgetter('end_time', 'key'))
-        future.sort(key=attrgetter('start_time'))
         context['active_participations'] = active
         context['current_contests'] = present
         context['future_contests'] = future
@@ -133,7 +142,7 @@ class ContestMixin(object):
     def is_organizer(self):
         if not self.request.user.is_authenticated:
             return False
-        return self.object.organizers.filter(id=self.request.profile.id).exists()
+        return self.request.profile.id in self.object.organizer_ids
 
     @cached_property
     def can_edit(self):
@@ -317,14 +326,17 @@ class ContestJoin(LoginRequiredMixin, ContestMixin, BaseDetailView):
                 raise ContestAccessDenied()
 
             while True:
-                virtual_id = max((ContestParticipation.objects.filter(contest=contest, user=profile)
-                                  .aggregate(virtual_id=Max('virtual'))['virtual_id'] or 0) + 1, 1)
                 try:
-                    participation = ContestParticipation.objects.create(
-                        contest=contest, user=profile, virtual=virtual_id,
-                        real_start=timezone.now(),
-                    )
-                # There is obviously a race condition here, so we keep trying until we win the race.
+                    with transaction.atomic():
+                        # Lock the profile row so concurrent joins by the same user cannot pick the same virtual id.
+                        Profile.objects.select_for_update().only('id').get(id=profile.id)
+                        virtual_id = max((ContestParticipation.objects.filter(contest=contest, user=profile)
+                                          .aggregate(virtual_id=Max('virtual'))['virtual_id'] or 0) + 1, 1)
+                        participation = ContestParticipation.objects.create(
+                            contest=contest, user=profile, virtual=virtual_id,
+                            real_start=timezone.now(),
+                        )
+                # Writers that don't take the profile lock (e.g. the admin) can still win the race, so try again.
                 except IntegrityError:
                     pass
                 else:
@@ -352,7 +364,7 @@ class ContestJoin(LoginRequiredMixin, ContestMixin, BaseDetailView):
                     )[0]
 
         profile.current_contest = participation
-        profile.save()
+        Profile.objects.filter(id=profile.id).update(current_contest=participation)
         contest._updating_stats_only = True
         contest.update_user_count()
         return HttpResponseRedirect(reverse('problem_list'))
@@ -409,12 +421,12 @@ class ContestCalendar(TitleMixin, ContestListMixin, TemplateView):
 
     def get_contest_data(self, start, end):
         end += timedelta(days=1)
-        contests = self.get_queryset().filter(Q(start_time__gte=start, start_time__lt=end) |
-                                              Q(end_time__gte=start, end_time__lt=end))
+        contests = self.get_queryset().filter(start_time__lt=end, end_time__gte=start)
         starts, ends, oneday = (defaultdict(list) for i in range(3))
+        tz = timezone.get_current_timezone()
         for contest in contests:
-            start_date = timezone.localtime(contest.start_time).date()
-            end_date = timezone.localtime(contest.end_time - timedelta(seconds=1)).date()
+            start_date = timezone.localtime(contest.start_time, tz).date()
+            end_date = timezone.localtime(contest.end_time - timedelta(seconds=1), tz).date()
             if start_date == end_date:
                 oneday[start_date].append(contest)
             else:
@@ -426,9 +438,11 @@ class ContestCalendar(TitleMixin, ContestListMixin, TemplateView):
         calendar = Calendar(self.firstweekday).monthdatescalendar(self.year, self.month)
         starts, ends, oneday = self.get_contest_data(make_aware(datetime.combine(calendar[0][0], time.min)),
                                                      make_aware(datetime.combine(calendar[-1][-1], time.min)))
+        weekday_classes, month, today = self.weekday_classes, self.month, self.today
+        # Use .get() so that empty days don't insert keys into the defaultdicts.
         return [[ContestDay(
-            date=date, weekday=self.weekday_classes[weekday], is_pad=date.month != self.month,
-            is_today=date == self.today, starts=starts[date], ends=ends[date], oneday=oneday[date],
+            date=date, weekday=weekday_classes[weekday], is_pad=date.month != month, is_today=date == today,
+            starts=starts.get(date, ()), ends=ends.get(date, ()), oneday=oneday.get(date, ()),
         ) for weekday, date in enumerate(week)] for week in calendar]
 
     def get_context_data(self, **kwargs):
@@ -441,7 +455,8 @@ class ContestCalendar(TitleMixin, ContestListMixin, TemplateView):
         else:
             context['title'] = _('Contests in %(month)s') % {'month': date_filter(month, _("F Y"))}
 
-        dates = Contest.objects.aggregate(min=Min('start_time'), max=Max('end_time'))
+        dates = cache.get_or_set('contest_bounds',
+                                 lambda: Contest.objects.aggregate(min=Min('start_time'), max=Max('end_time')), 300)
         min_month = (self.today.year, self.today.month)
         if dates['min'] is not None:
             min_month = dates['min'].year, dates['min'].month
@@ -471,15 +486,20 @@ class ContestCalendar(TitleMixin, ContestListMixin, TemplateView):
 
 
 class CachedContestCalendar(ContestCalendar):
-    def render(self):
-        key = 'contest_cal:%d:%d' % (self.year, self.month)
-        cached = cache.get(key)
-        if cached is not None:
-            return HttpResponse(cached)
-        response = super(CachedContestCalendar, self).render()
-        response.render()
-        cached.set(key, response.content)
-        return response
+    def get_table(self):
+        # Only anonymous users are guaranteed to see the same contests, so everyone else gets an uncached table.
+        # The rest of the page (navigation, CSRF token, translations) is always rendered per request.
+        if self.request.user.is_authenticated:
+            return super(CachedContestCalendar, self).get_table()
+
+        # Contests are bucketed into days in the current timezone.
+        key = 'contest_cal:%d:%d:%s' % (self.year, self.month, timezone.get_current_timezone_name())
+        timeout = 86400
+        if (self.year, self.month) >= (self.today.year, self.today.month):
+            # Current and upcoming months highlight today, so they can only be reused within the same day.
+            key += ':%s' % self.today.isoformat()
+            timeout = 3600
+        return cache.get_or_set(key, super(CachedContestCalendar, self).get_table, timeout)
 
 
 class ContestStats(TitleMixin, ContestMixin, DetailView):
@@ -559,11 +579,14 @@ BestSolutionData = namedtuple('BestSolutionData', 'code points time state is_pre
 
 
 def make_contest_ranking_profile(contest, participation, contest_problems):
+    contest_format = contest.format
+    format_user_problem = contest_format.display_user_problem
+
     def display_user_problem(contest_problem):
         # When the contest format is changed, `format_data` might be invalid.
         # This will cause `display_user_problem` to error, so we display '???' instead.
         try:
-            return contest.format.display_user_problem(participation, contest_problem)
+            return format_user_problem(participation, contest_problem)
         except (KeyError, TypeError, ValueError):
             return mark_safe('<td>???</td>')
 
@@ -579,27 +602,40 @@ def make_contest_ranking_profile(contest, participation, contest_problems):
         organization=user.organization,
         participation_rating=participation.rating.rating if hasattr(participation, 'rating') else None,
         problem_cells=[display_user_problem(contest_problem) for contest_problem in contest_problems],
-        result_cell=contest.format.display_participation_result(participation),
+        result_cell=contest_format.display_participation_result(participation),
         participation=participation,
     )
 
 
 def base_contest_ranking_list(contest, problems, queryset):
     return [make_contest_ranking_profile(contest, participation, problems) for participation in
-            queryset.select_related('user__user', 'rating').defer('user__about', 'user__organizations__about')]
+            queryset.select_related('user__user', 'rating').prefetch_related('user__organizations')
+                    .defer('user__about', 'user__user_script', 'user__notes', 'user__totp_key',
+                           'user__scratch_codes', 'user__api_token', 'user__organizations__about')]
 
 
 def contest_ranking_list(contest, problems):
-    return base_contest_ranking_list(contest, problems, contest.users.filter(virtual=0, user__is_unlisted=False)
-                                     .prefetch_related('user__organizations')
-                                     .order_by('is_disqualified', '-score', 'cumtime', 'tiebreaker'))
+    order = (F('is_disqualified').asc(), F('score').desc(), F('cumtime').asc(), F('tiebreaker').asc())
+    queryset = contest.users.filter(virtual=0, user__is_unlisted=False).order_by(*order)
+    if connection.features.supports_over_clause:
+        queryset = queryset.annotate(rank=Window(expression=Rank(), order_by=order))
+    return base_contest_ranking_list(contest, problems, queryset)
+
+
+def contest_ranker(users, key):
+    # Use the ranks computed by the database when available, otherwise rank in Python.
+    # Materialize first, since ranking lists may be any iterable, not just a list.
+    users = list(users)
+    if users and hasattr(users[0].participation, 'rank'):
+        return ((user.participation.rank, user) for user in users)
+    return ranker(users, key=key)
 
 
 def get_contest_ranking_list(request, contest, participation=None, ranking_list=contest_ranking_list,
-                             show_current_virtual=True, ranker=ranker):
+                             show_current_virtual=True, ranker=contest_ranker):
     problems = list(contest.contest_problems.select_related('problem').defer('problem__description').order_by('order'))
 
-    users = ranker(ranking_list(contest, problems), key=attrgetter('points', 'cumtime', 'tiebreaker'))
+    users = list(ranker(ranking_list(contest, problems), key=attrgetter('points', 'cumtime', 'tiebreaker')))
 
     if show_current_virtual:
         if participation is None and request.user.is_authenticated:
@@ -607,7 +643,10 @@ def get_contest_ranking_list(request, contest, participation=None, ranking_list=
             if participation is None or participation.contest_id != contest.id:
                 participation = None
         if participation is not None and participation.virtual:
-            users = chain([('-', make_contest_ranking_profile(contest, participation, problems))], users)
+            # Load the virtual row through the same batched queryset as the scoreboard, rather than
+            # lazily fetching its user, organizations and rating one attribute at a time.
+            virtual = base_contest_ranking_list(contest, problems, contest.users.filter(id=participation.id))
+            users = [('-', user) for user in virtual] + users
     return users, problems
 
 
@@ -619,13 +658,25 @@ def contest_ranking_ajax(request, contest, participation=None):
     if not contest.can_see_full_scoreboard(request.user):
         raise Http404()
 
-    users, problems = get_contest_ranking_list(request, contest, participation)
-    return render(request, 'contest/ranking-table.html', {
-        'users': users,
-        'problems': problems,
-        'contest': contest,
-        'has_rating': contest.ratings.exists(),
-    })
+    def render_ranking_table():
+        users, problems = get_contest_ranking_list(request, contest, participation)
+        return render_to_string('contest/ranking-table.html', {
+            'users': users,
+            'problems': problems,
+            'contest': contest,
+            'has_rating': any(user.participation_rating is not None for _rank, user in users),
+        }, request)
+
+    current = participation or request.participation
+    if current is not None and current.virtual and current.contest_id == contest.id:
+        # The viewer's own virtual participation is shown at the top, so this table can't be shared.
+        return HttpResponse(render_ranking_table())
+
+    # The ranking version changes whenever a participation is rescored; the timeout covers other changes,
+    # such as new participants joining.
+    key = 'contest_ranking:%d:%s:%s:%s' % (contest.id, contest.ranking_version, request.LANGUAGE_CODE,
+                                           timezone.get_current_timezone_name())
+    return HttpResponse(cache.get_or_set(key, render_ranking_table, 30))
 
 
 class ContestRankingBase(ContestMixin, TitleMixin, DetailView):
@@ -674,7 +725,7 @@ class ContestRanking(ContestRankingBase):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['has_rating'] = self.object.ratings.exists()
+        context['has_rating'] = any(user.participation_rating is not None for _rank, user in context['users'])
         return context
 
 